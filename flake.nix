@@ -106,7 +106,8 @@
               serviceConfig = {
                 DynamicUser = true;
                 EnvironmentFile = cfg.environmentFile;
-                ExecStart = "${self.packages.${pkgs.system}.label-approved}/bin/label-approved";
+                StateDirectory = "label-approved";
+                ExecStart = "${self.packages.${pkgs.system}.label-approved}/bin/label-approved --state_file /var/lib/label-approved/state.json";
               };
             };
           };
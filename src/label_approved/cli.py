@@ -1,20 +1,22 @@
 import argparse
+import json
 import logging
 import os
 import shutil
 import subprocess
 import sys
 import time
-from dataclasses import dataclass
-from datetime import datetime
-from string import Template
-from typing import Any, Optional
+from dataclasses import dataclass, field
+from typing import Any, ClassVar, Iterator, Optional
 
 import requests
 from github import Github
 from github.Consts import DEFAULT_SECONDS_BETWEEN_REQUESTS, DEFAULT_SECONDS_BETWEEN_WRITES
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 DEFAULT_REPO = "NixOS/nixpkgs"
+MAINTAINERS_STATUS_CONTEXT = "ofborg-eval-check-maintainers"
 
 
 def ghtoken() -> str:
@@ -32,6 +34,84 @@ def ghtoken() -> str:
     sys.exit(1)
 
 
+_METADATA_FRAGMENT = """
+    id
+    number
+    url
+    createdAt
+    updatedAt
+    commits(last: 1) {
+      nodes {
+        commit {
+          committedDate
+          status {
+            contexts {
+              context
+              targetUrl
+            }
+          }
+        }
+      }
+    }
+    labels(first: 100) {
+      nodes {
+        name
+      }
+    }
+    reviews(last: 100) {
+      nodes {
+        state
+        submittedAt
+        author {
+          login
+        }
+      }
+    }
+"""
+
+_SEARCH_QUERY = f"""
+    query($query: String!, $after: String) {{
+      rateLimit {{
+        limit
+        cost
+        remaining
+        resetAt
+      }}
+      search(
+        first: 100,
+        after: $after,
+        query: $query,
+        type: ISSUE,
+      ) {{
+        issueCount
+        pageInfo {{
+          hasNextPage
+          endCursor
+        }}
+        nodes {{
+          ... on PullRequest {{
+            {_METADATA_FRAGMENT}
+          }}
+        }}
+      }}
+    }}
+"""
+
+
+class GraphQLError(Exception):
+    pass
+
+
+@dataclass
+class LabelMutation:
+    __slots__ = ("name", "pr_id", "labels")
+
+    # addLabelsToLabelable or removeLabelsFromLabelable
+    name: str
+    pr_id: str
+    labels: set[str]
+
+
 @dataclass
 class GraphQL:
     token: str
@@ -39,136 +119,144 @@ class GraphQL:
     repo: str = DEFAULT_REPO
     seconds_between_requests: float = DEFAULT_SECONDS_BETWEEN_REQUESTS
     seconds_between_writes: float = DEFAULT_SECONDS_BETWEEN_WRITES
-    metadata: str = """
-        id
-        number
-        url
-        createdAt
-        commits(last: 1) {
-          edges {
-            node {
-              commit {
-                committedDate
-                status {
-                  contexts {
-                    context
-                    targetUrl
-                  }
-                }
-              }
-            }
-          }
-        }
-        labels(first: 100) {
-          edges {
-            node {
-              id
-              name
-            }
-          }
-        }
-        reviews(first: 100) {
-          edges {
-            node {
-              state
-              submittedAt
-              author {
-                login
-              }
-            }
-          }
-        }
-    """
-
-    def query(self, query: str) -> Any:
-        headers = {"Authorization": f"token {self.token}"}
-        for _ in range(self.retries):
-            time.sleep(self.seconds_between_writes if "mutation" in query else self.seconds_between_requests)
-            try:
-                r = requests.post("https://api.github.com/graphql", headers=headers, json={"query": query})
-                r.raise_for_status()
-                return r.json()
-            except requests.exceptions.RequestException as e:
-                logging.warning("Failed to query GraphQL: %s", e)
-        raise Exception("Failed to query GraphQL after multiple retries")
-
-    def search_issues(self, filters: str) -> Any:
-        query_template = Template("""
-            query {
-              rateLimit {
-                limit
-                cost
-                remaining
-                resetAt
-              }
-              search(
-                first: 100,
-                query: "repo:$repo $filters",
-                type: ISSUE,
-              ) {
-                issueCount
-                nodes {
-                  ... on PullRequest {
-                    $metadata
-                  }
-                }
-              }
-            }
-        """)
-        query = query_template.substitute(repo=self.repo, filters=filters, metadata=self.metadata)
-        return self.query(query)
+    # keeps a single mutation request well below GitHub's timeouts and secondary rate limits
+    mutations_per_request: int = 25
+    metadata: ClassVar[str] = _METADATA_FRAGMENT
+    label_ids: dict[str, str] = field(default_factory=dict)
+    _last_request_at: float = field(default=0.0, init=False, repr=False)
+    # keeps the connection to the API alive between requests instead of a new TLS handshake every time
+    _session: requests.Session = field(default_factory=requests.Session, init=False, repr=False)
+    _owner: str = field(init=False, repr=False)
+    _name: str = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        self._owner, self._name = self.repo.split("/")
+        self._session.headers["Authorization"] = f"token {self.token}"
+        # all requests are POSTs, allowed_methods=None lets urllib3 retry them too
+        retry = Retry(total=self.retries, backoff_factor=1, status_forcelist=[429, 502, 503, 504], allowed_methods=None)
+        self._session.mount("https://", HTTPAdapter(max_retries=retry))
+
+    def _wait_between_requests(self, query: str) -> None:
+        # only sleep for whatever is left of the interval, the time spent on the
+        # previous request and on processing its result already counts towards it
+        interval = self.seconds_between_writes if "mutation" in query else self.seconds_between_requests
+        remaining = self._last_request_at + interval - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+        self._last_request_at = time.monotonic()
+
+    def _post(self, query: str, variables: Optional[dict[str, Any]] = None) -> Any:
+        self._wait_between_requests(query)
+        r = self._session.post("https://api.github.com/graphql", json={"query": query, "variables": variables or {}})
+        r.raise_for_status()
+        return r.json()
+
+    def query(self, query: str, variables: Optional[dict[str, Any]] = None) -> Any:
+        response = self._post(query, variables)
+        # GraphQL failures such as RATE_LIMITED come back as HTTP 200 with an errors list
+        if response.get("errors"):
+            raise GraphQLError(response["errors"])
+        return response
+
+    def search_issues(self, filters: str, after: Optional[str] = None) -> Any:
+        return self.query(_SEARCH_QUERY, {"query": f"repo:{self.repo} {filters}", "after": after})
+
+    def search_pulls(self, filters: str) -> Iterator[Any]:
+        """Yields the search result pages, newest PRs first, every PR only once.
+
+        GitHub stops paginating a search after 1000 results, so once the cursor runs out the
+        search continues with the PRs created at or before the last one seen.
+        """
+        filters = f"{filters} sort:created-desc"
+        metadata = self.search_issues(filters)
+        logging.info("Pulls total for '%s': %s", filters, metadata["data"]["search"]["issueCount"])
+
+        seen: set[int] = set()
+        window_filters = filters
+        window_count = 0
+        window_new = 0
+        while True:
+            search = metadata["data"]["search"]
+            if not search["nodes"]:
+                return
+            window_count += len(search["nodes"])
+            last_created_at = search["nodes"][-1]["createdAt"]
+            # the next window starts at the last creation date, so PRs created at the same time are not skipped
+            search["nodes"] = [p_r for p_r in search["nodes"] if p_r["number"] not in seen]
+            seen.update(p_r["number"] for p_r in search["nodes"])
+            window_new += len(search["nodes"])
+            yield metadata
+
+            if search["pageInfo"]["hasNextPage"]:
+                metadata = self.search_issues(window_filters, search["pageInfo"]["endCursor"])
+            # a window without any new PRs means the search is exhausted, whatever issueCount says
+            elif window_count < search["issueCount"] and window_new:
+                window_filters = f"{filters} created:<={last_created_at}"
+                window_count = 0
+                window_new = 0
+                metadata = self.search_issues(window_filters)
+            else:
+                return
+
+    def get_pulls(self, numbers: list[int]) -> dict[int, Any]:
+        parameters = "".join(f", $number{i}: Int!" for i in range(len(numbers)))
+        pulls = " ".join(f"pr{i}: pullRequest(number: $number{i}) {{ {self.metadata} }}" for i in range(len(numbers)))
+        query = f"""
+            query($owner: String!, $name: String!{parameters}) {{
+              repository(owner: $owner, name: $name) {{
+                {pulls}
+              }}
+            }}
+        """
+        variables: dict[str, Any] = {"owner": self._owner, "name": self._name}
+        variables.update({f"number{i}": number for i, number in enumerate(numbers)})
+        repository = self.query(query, variables)["data"]["repository"]
+        return {number: repository[f"pr{i}"] for i, number in enumerate(numbers)}
 
     def get_pull(self, number: int) -> Any:
-        query_template = Template("""
-            query {
-              repository(owner: "$owner", name: "$name") {
-                pullRequest(number: $number) {
-                  $metadata
-                }
-              }
-            }
-        """)
-        owner = self.repo.split("/")[0]
-        name = self.repo.split("/")[1]
-        query = query_template.substitute(owner=owner, name=name, number=number, metadata=self.metadata)
-        return self.query(query)["data"]["repository"]["pullRequest"]
-
-    def get_label_id(self, label: str) -> str:
-        query_template = Template("""
-            query {
-              repository(owner: "$owner", name: "$name") {
-                label(name: "$label") {
-                  id
-                }
-              }
-            }
-        """)
-        owner = self.repo.split("/")[0]
-        name = self.repo.split("/")[1]
-        query = query_template.substitute(owner=owner, name=name, label=label)
-        return str(self.query(query)["data"]["repository"]["label"]["id"])
-
-    def add_labels_to_pr(self, pr_id: str, label_ids: list[str]) -> None:
-        query_template = Template("""
-            mutation {
-              addLabelsToLabelable(input: {labelableId: "$pr_id", labelIds: [$label_ids]}) {
-                clientMutationId
-              }
-            }
-        """)
-        query = query_template.substitute(pr_id=pr_id, label_ids=", ".join(f'"{label_id}"' for label_id in label_ids))
-        self.query(query)
-
-    def remove_labels_from_pr(self, pr_id: str, label_ids: list[str]) -> None:
-        query_template = Template("""
-            mutation {
-              removeLabelsFromLabelable(input: {labelableId: "$pr_id", labelIds: [$label_ids]}) {
-                clientMutationId
-              }
-            }
-        """)
-        query = query_template.substitute(pr_id=pr_id, label_ids=", ".join(f'"{label_id}"' for label_id in label_ids))
-        self.query(query)
+        return self.get_pulls([number])[number]
+
+    def get_label_ids(self, labels: list[str]) -> dict[str, str]:
+        parameters = "".join(f", $label{i}: String!" for i in range(len(labels)))
+        aliases = " ".join(f"l{i}: label(name: $label{i}) {{ id }}" for i in range(len(labels)))
+        query = f"""
+            query($owner: String!, $name: String!{parameters}) {{
+              repository(owner: $owner, name: $name) {{
+                {aliases}
+              }}
+            }}
+        """
+        variables: dict[str, Any] = {"owner": self._owner, "name": self._name}
+        variables.update({f"label{i}": label for i, label in enumerate(labels)})
+        repository = self.query(query, variables)["data"]["repository"]
+        return {label: str(repository[f"l{i}"]["id"]) for i, label in enumerate(labels)}
+
+    def apply_label_mutations(self, mutations: list[LabelMutation]) -> set[str]:
+        """Applies the label changes of many PRs with as few requests as possible.
+
+        Returns the ids of the PRs for which at least one label change failed.
+        """
+        failed: set[str] = set()
+        for start in range(0, len(mutations), self.mutations_per_request):
+            batch = mutations[start : start + self.mutations_per_request]
+            parameters = ", ".join(f"$id{i}: ID!, $labelIds{i}: [ID!]!" for i in range(len(batch)))
+            aliases = " ".join(
+                f"m{i}: {mutation.name}(input: {{labelableId: $id{i}, labelIds: $labelIds{i}}}) {{ clientMutationId }}"
+                for i, mutation in enumerate(batch)
+            )
+            variables: dict[str, Any] = {}
+            for i, mutation in enumerate(batch):
+                variables[f"id{i}"] = mutation.pr_id
+                variables[f"labelIds{i}"] = [self.label_ids[label] for label in sorted(mutation.labels)]
+            response = self._post(f"mutation({parameters}) {{ {aliases} }}", variables)
+            if not response.get("errors"):
+                continue
+            for error in response["errors"]:
+                logging.warning("Failed to update labels: %s", error.get("message", error))
+            # a failed alias is null in data, data itself is null if the whole request failed
+            data = response.get("data") or {}
+            failed.update(mutation.pr_id for i, mutation in enumerate(batch) if data.get(f"m{i}") is None)
+        return failed
 
 
 label_dict: dict[int, str] = {
@@ -177,6 +265,8 @@ label_dict: dict[int, str] = {
     2: "12.approvals: 2",
     3: "12.approvals: 3+",
 }
+_LABEL_VALUES: frozenset[str] = frozenset(label_dict.values())
+_MAX_APPROVALS: int = max(label_dict.keys())
 
 
 @dataclass
@@ -185,52 +275,75 @@ class Settings:
 
 
 @dataclass
-class Review:
-    author: str
-    state: str
-    submitted_at: datetime
-
-
-@dataclass
-class Status:
-    context: str
-    target_url: str
+class State:
+    """Revisions of the PRs processed by the previous crawl and their maintainer gists, persisted between runs."""
+
+    path: Optional[str]
+    pulls: dict[str, str] = field(default_factory=dict)
+    gists: dict[str, frozenset[str]] = field(default_factory=dict)
+
+    @classmethod
+    def load(cls, path: Optional[str]) -> "State":
+        if path is None or not os.path.exists(path):
+            return cls(path)
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        gists = {gist_id: frozenset(maintainers) for gist_id, maintainers in data.get("gists", {}).items()}
+        return cls(path, data.get("pulls", {}), gists)
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            gists = {gist_id: sorted(maintainers) for gist_id, maintainers in self.gists.items()}
+            json.dump({"pulls": self.pulls, "gists": gists}, f)
+        os.replace(tmp_path, self.path)
 
 
 @dataclass
 class PrWithGraphQL:
-    g_h_graphql: GraphQL
+    __slots__ = ("mutations", "metadata", "dry_run")
+
+    mutations: list[LabelMutation]
     metadata: Any
-    label_ids: dict[str, str]
     dry_run: bool
 
     def get_number(self) -> int:
         return int(self.metadata["number"])
 
-    def get_reviews(self) -> list[Review]:
-        reviews: list[Review] = []
-        for review in self.metadata["reviews"]["edges"]:
+    def iter_reviews(self) -> Iterator[tuple[str, str, str]]:
+        """Yields (lowercased author, state, submittedAt) of every review, oldest first.
+
+        submittedAt is ISO 8601 in UTC, e.g. 2024-01-31T12:00:00Z, so the timestamps compare correctly as strings.
+        """
+        for review in self.metadata["reviews"]["nodes"]:
             # can be None if the account has been removed
-            author = review["node"]["author"]["login"] if review["node"]["author"] else "ghost"
-            submitted_at = datetime.fromisoformat(review["node"]["submittedAt"][:-1])
-            reviews.append(Review(author, review["node"]["state"], submitted_at))
-        return reviews
+            author = review["author"]["login"].lower() if review["author"] else "ghost"
+            yield author, review["state"], review["submittedAt"]
 
-    def get_last_commit_date(self) -> Optional[datetime]:
-        commits = self.metadata["commits"]["edges"]
+    def get_last_commit_date(self) -> Optional[str]:
+        commits = self.metadata["commits"]["nodes"]
         if not commits:
             return None
-        return datetime.fromisoformat(commits[0]["node"]["commit"]["committedDate"][:-1])
+        return str(commits[0]["commit"]["committedDate"])
+
+    def find_status(self, context_name: str) -> Optional[str]:
+        """Returns the target url of the last commit's status with the given context, if any."""
+        commits = self.metadata["commits"]["nodes"]
+        if not commits or not commits[0]["commit"]["status"]:
+            return None
+        for context in commits[0]["commit"]["status"]["contexts"]:
+            if context["context"] == context_name:
+                return str(context["targetUrl"]) if context["targetUrl"] else None
+        return None
 
-    def get_last_commit_statuses(self) -> list[Status]:
-        commits = self.metadata["commits"]["edges"]
-        if not commits or not commits[0]["node"]["commit"]["status"]:
-            return []
-        contexts = commits[0]["node"]["commit"]["status"]["contexts"]
-        return [Status(context["context"], context["targetUrl"]) for context in contexts]
+    def get_revision(self) -> str:
+        # adding a commit status does not bump updatedAt, but get_maintainers depends on it
+        return f"{self.metadata['updatedAt']} {self.find_status(MAINTAINERS_STATUS_CONTEXT) or ''}"
 
     def get_labels(self) -> set[str]:
-        return {label["node"]["name"] for label in self.metadata["labels"]["edges"]}
+        return {label["name"] for label in self.metadata["labels"]["nodes"]}
 
     def add_labels(self, labels: set[str]) -> None:
         if not labels:
@@ -238,7 +351,7 @@ class PrWithGraphQL:
         for label in labels:
             logging.info("Adding label '%s' to PR: '%s' %s", label, self.metadata["number"], self.metadata["url"])
         if not self.dry_run:
-            self.g_h_graphql.add_labels_to_pr(self.metadata["id"], [self.label_ids[label] for label in labels])
+            self.mutations.append(LabelMutation("addLabelsToLabelable", self.metadata["id"], labels))
 
     def remove_labels(self, labels: set[str]) -> None:
         if not labels:
@@ -246,7 +359,7 @@ class PrWithGraphQL:
         for label in labels:
             logging.info("Removing label '%s' from PR: '%s' %s", label, self.metadata["number"], self.metadata["url"])
         if not self.dry_run:
-            self.g_h_graphql.remove_labels_from_pr(self.metadata["id"], [self.label_ids[label] for label in labels])
+            self.mutations.append(LabelMutation("removeLabelsFromLabelable", self.metadata["id"], labels))
 
 
 settings = Settings()
@@ -256,43 +369,57 @@ else:
     logging.basicConfig(level=logging.INFO)
 
 
-def get_maintainers(g_h: Github, p_r_object: PrWithGraphQL) -> Optional[set[str]]:
-    for status in p_r_object.get_last_commit_statuses():
-        if status.context == "ofborg-eval-check-maintainers":
-            gist_url = status.target_url
-            if gist_url:
-                gist_id = gist_url.rsplit("/", 1)[-1]
+@dataclass
+class GistMaintainers:
+    """Maintainers listed in ofborg's gists, cached by gist id as a gist doesn't change once created."""
 
-                gist = g_h.get_gist(gist_id)
-                pot_maint_file_contents = gist.files["Potential Maintainers"].content
-                maintainers: set[str] = set()
-                for line in pot_maint_file_contents.splitlines():
-                    if line == "Maintainers:":
-                        continue
-                    maintainer = line.split(":")[0].strip()
-                    maintainers.add(maintainer)
-                return maintainers
-    return None
+    g_h: Github
+    cache: dict[str, frozenset[str]] = field(default_factory=dict)
+
+    def get(self, gist_id: str) -> frozenset[str]:
+        if gist_id not in self.cache:
+            gist = self.g_h.get_gist(gist_id)
+            pot_maint_file_contents = gist.files["Potential Maintainers"].content
+            self.cache[gist_id] = frozenset(
+                line.partition(":")[0].strip()
+                for line in pot_maint_file_contents.splitlines()
+                if line and line != "Maintainers:"
+            )
+        return self.cache[gist_id]
 
 
-def process_pr(g_h: Github, p_r_object: PrWithGraphQL) -> None:
+def get_maintainers_gist_id(p_r_object: PrWithGraphQL) -> Optional[str]:
+    gist_url = p_r_object.find_status(MAINTAINERS_STATUS_CONTEXT)
+    if not gist_url:
+        return None
+    return gist_url.rsplit("/", 1)[-1]
+
+
+def get_maintainers(gist_maintainers: GistMaintainers, p_r_object: PrWithGraphQL) -> Optional[frozenset[str]]:
+    gist_id = get_maintainers_gist_id(p_r_object)
+    if gist_id is None:
+        return None
+    return gist_maintainers.get(gist_id)
+
+
+def process_pr(gist_maintainers: GistMaintainers, p_r_object: PrWithGraphQL) -> None:
     logging.info("Processing %s", p_r_object.get_number())
 
     logging.debug(p_r_object)
 
-    p_r_reviews = p_r_object.get_reviews()
-
     approved_users: set[str] = set()
     last_approved_review_date = None
-    for review in p_r_reviews:
-        reviewed_user = review.author.lower()
-        if review.state == "APPROVED":
+    for reviewed_user, state, submitted_at in p_r_object.iter_reviews():
+        if state == "APPROVED":
             approved_users.add(reviewed_user)
-            last_approved_review_date = review.submitted_at
+            last_approved_review_date = submitted_at
         else:
             approved_users.discard(reviewed_user)
 
-    old_labels: set[str] = p_r_object.get_labels() & set(label_dict.values())
+    old_labels: set[str] = p_r_object.get_labels() & _LABEL_VALUES
+    # never approved and not labeled, nothing to add or remove
+    if last_approved_review_date is None and not old_labels:
+        return
 
     labels: set[str] = set()
     if last_approved_review_date is not None:
@@ -305,11 +432,11 @@ def process_pr(g_h: Github, p_r_object: PrWithGraphQL) -> None:
         logging.info("lastcommitdate: %s", last_commit_date)
 
         if last_commit_date <= last_approved_review_date:
-            approval_count = min(len(approved_users), max(label_dict.keys()))
+            approval_count = min(len(approved_users), _MAX_APPROVALS)
             if approval_count:
                 labels.add(label_dict[approval_count])
 
-                maintainers = get_maintainers(g_h, p_r_object)
+                maintainers = get_maintainers(gist_maintainers, p_r_object)
                 if maintainers is None:
                     old_labels.discard(label_dict[-1])
                 elif approved_users & maintainers:
@@ -324,6 +451,10 @@ def main() -> None:
     parser.add_argument("--dry_run", action="store_true")
     parser.add_argument("--repo", default=DEFAULT_REPO)
     parser.add_argument("--single_pr", type=int, help="Run on a single PR instead of crawling the repository")
+    parser.add_argument(
+        "--state_file",
+        help="Remember PRs between crawls in this file and skip the ones that did not change since the last run",
+    )
     args = parser.parse_args()
 
     g_h_token = ghtoken()
@@ -333,14 +464,15 @@ def main() -> None:
     if args.dry_run:
         logging.warning("Running in dry run mode, no changes will be applied")
 
-    label_ids = {}
-    for label in label_dict.values():
-        logging.info("Retrieving label id for '%s'", label)
-        label_ids[label] = g_h_graphql.get_label_id(label)
+    logging.info("Retrieving label ids for %s", ", ".join(f"'{label}'" for label in label_dict.values()))
+    g_h_graphql.label_ids = g_h_graphql.get_label_ids(list(label_dict.values()))
 
     if args.single_pr is not None:
         p_r = g_h_graphql.get_pull(args.single_pr)
-        process_pr(g_h, PrWithGraphQL(g_h_graphql, p_r, label_ids, args.dry_run))
+        mutations: list[LabelMutation] = []
+        process_pr(GistMaintainers(g_h), PrWithGraphQL(mutations, p_r, args.dry_run))
+        if g_h_graphql.apply_label_mutations(mutations):
+            sys.exit(1)
     else:
         query: list[str] = [
             # "author:r-ryantm",
@@ -357,19 +489,60 @@ def main() -> None:
             "is:open",
             f"repo:{args.repo}",
         ]
-        metadata = g_h_graphql.search_issues(" ".join(query))
-        logging.info("Pulls total: %s", metadata["data"]["search"]["issueCount"])
-
-        pulls = metadata["data"]["search"]["nodes"]
-        while pulls:
-            for p_r in pulls:
-                process_pr(g_h, PrWithGraphQL(g_h_graphql, p_r, label_ids, args.dry_run))
-
-            logging.info("Remaining GraphQL API rate limit: %s", metadata["data"]["rateLimit"]["remaining"])
-            logging.info("Remaining REST API rate limit: %s", g_h.get_rate_limit().core.remaining)
+        approval_labels = ",".join(f'"{label}"' for label in label_dict.values())
+        searches: list[list[str]] = [
+            # approvals can only come from PRs that got at least one review
+            [*query, "-review:none"],
+            # labeled PRs may need their labels removed, e.g. after new commits
+            [*query, f"label:{approval_labels}"],
+        ]
 
-            metadata = g_h_graphql.search_issues(f'{" ".join(query)} created:<{pulls[-1]["createdAt"]}')
-            pulls = metadata["data"]["search"]["nodes"]
+        state = State.load(args.state_file)
+        revisions: dict[str, str] = {}
+        # PRs whose label changes were not applied, they must be processed again by the next run
+        failed: set[str] = set()
+        gist_maintainers = GistMaintainers(g_h, state.gists)
+        gist_ids: set[str] = set()
+
+        for search in searches:
+            for metadata in g_h_graphql.search_pulls(" ".join(search)):
+                page_mutations: list[LabelMutation] = []
+                for p_r in metadata["data"]["search"]["nodes"]:
+                    p_r_object = PrWithGraphQL(page_mutations, p_r, args.dry_run)
+                    number = str(p_r_object.get_number())
+                    # PRs that are both reviewed and labeled show up in both searches
+                    if number in revisions:
+                        continue
+                    revisions[number] = p_r_object.get_revision()
+                    gist_id = get_maintainers_gist_id(p_r_object)
+                    if gist_id is not None:
+                        gist_ids.add(gist_id)
+                    if state.pulls.get(number) == revisions[number]:
+                        logging.debug("Skipping %s, unchanged since the last run", number)
+                        continue
+                    process_pr(gist_maintainers, p_r_object)
+                failed_ids = g_h_graphql.apply_label_mutations(page_mutations)
+                for p_r in metadata["data"]["search"]["nodes"]:
+                    if p_r["id"] in failed_ids:
+                        failed.add(str(p_r["number"]))
+
+                logging.info("Remaining GraphQL API rate limit: %s", metadata["data"]["rateLimit"]["remaining"])
+
+                # checkpoint after every page, a crawl that dies halfway then skips what it already applied;
+                # a flush that raised never gets here and PRs whose label changes failed are left out
+                if not args.dry_run:
+                    applied = {number: revision for number, revision in revisions.items() if number not in failed}
+                    State(state.path, {**state.pulls, **applied}, state.gists).save()
+
+        # in dry run mode nothing was applied, so the next run has to look at every PR again
+        if not args.dry_run:
+            # only the PRs seen by this crawl, closed ones drop out
+            state.pulls = {number: revision for number, revision in revisions.items() if number not in failed}
+            # only keep the gists that open PRs still point at
+            state.gists = {
+                gist_id: maintainers for gist_id, maintainers in gist_maintainers.cache.items() if gist_id in gist_ids
+            }
+            state.save()
 
 
 if __name__ == "__main__":